@@ -1,7 +1,10 @@
 
 import streamlit as st
 import re
-from collections import OrderedDict
+import json
+import heapq
+import math
+from collections import Counter, OrderedDict
 
 st.set_page_config(page_title="Kling Prompt Perfecter", page_icon="✨", layout="centered")
 
@@ -91,29 +94,146 @@ EFFECTS = _kw("sparks","embers","smoke","steam","dust","particles","glitter","ra
 # -----------------------------
 # Helpers
 # -----------------------------
-def find_terms(text, vocab):
-    found = []
+VOCAB_KEYS = [
+    "CHAR_ROLES", "CLOTHING", "PHYS_ATTR", "OBJECTS", "ENVIRONMENTS", "TIME_OF_DAY", "WEATHER", "LIGHTING",
+    "COLORS", "CAMERA", "COMPOSITION", "MOOD", "STYLE", "QUALITY", "EFFECTS"
+]
+
+EXTRACTION_CACHE_SIZE = 16
+
+# Process-wide caches are shared by every session and keyed partly on user-supplied custom packs, so bound them
+VOCAB_CACHE_SIZE = 32
+PATTERN_CACHE_SIZE = VOCAB_CACHE_SIZE * len(VOCAB_KEYS)
+
+# Salience: IDF x priority, decayed by how late a term first appears in the text
+PACK_PRIORITY = 1.5
+CUSTOM_PRIORITY = 2.0
+POSITION_DECAY = 0.5
+
+@st.cache_resource(max_entries=PATTERN_CACHE_SIZE)
+def term_patterns(terms):
+    # Compiled once per vocabulary; there are more terms than the re module caches internally.
+    return [(term, re.compile(rf'(?<!\w){re.escape(term)}(?!\w)')) for term in terms]
+
+def term_spans(text, vocab):
+    # Every (start, end) match of each vocab term, longest terms first
     t = text.lower()
-    for term in sorted(vocab, key=lambda x: -len(x)):
-        if re.search(rf'(?<!\w){re.escape(term)}(?!\w)', t):
-            found.append(term)
-    ordered = []
-    for term in found:
-        if term not in ordered:
-            ordered.append(term)
-    return ordered
-
-def proper_names(text):
+    terms = tuple(sorted(vocab, key=lambda x: (-len(x), x)))
+    spans = {}
+    for term, pattern in term_patterns(terms):
+        found = [m.span() for m in pattern.finditer(t)]
+        if found:
+            spans[term] = found
+    return spans
+
+def proper_names(text, environments=ENVIRONMENTS):
     names = []
     for line in re.split(r'[\n]', text):
         tokens = re.findall(r"\b[A-Z][a-zA-Z'-]+\b", line)
         for tok in tokens:
-            if tok.lower() not in ENVIRONMENTS and tok not in names:
+            if tok.lower() not in environments and tok not in names:
                 names.append(tok)
     return names
 
-def compress_list(items, max_items):
-    return items[:max_items] if max_items and max_items > 0 else items
+def term_tokens(term):
+    # Rough token cost: one per word
+    return len(term.split())
+
+def salience(weight, position, text_len):
+    if not text_len:
+        return weight
+    return weight * (1.0 - POSITION_DECAY * position / text_len)
+
+def overlaps(a, b):
+    return f" {a} " in f" {b} " or f" {b} " in f" {a} "
+
+def inside_longer(spans, taken):
+    # True when every match lies inside a longer match that was already picked
+    return bool(spans) and all(
+        any(s <= a and b <= e and b - a < e - s for s, e in taken) for a, b in spans
+    )
+
+def select_terms(sections, max_items=0, token_budget=0, reserved=None):
+    # sections maps label -> [(term, score, source vocab key, match spans)]; reserved maps terms that
+    # are already in the prompt outside the ranking to their match spans, and they are never repeated.
+    # Every non-empty section first gets its best term, then one heap over all sections hands out
+    # the rest of the shared budget. Ties fall back to section order and then original order.
+    heap = []
+    for s_idx, (label, candidates) in enumerate(sections.items()):
+        for i, (term, score, source, spans) in enumerate(candidates):
+            heap.append((-score, s_idx, i, label, term, source, spans))
+    entries = list(heap)
+    heapq.heapify(heap)
+
+    chosen = OrderedDict((label, []) for label in sections)
+    kept = {label: [] for label in sections}
+    reserved = reserved or {}
+    taken = set(reserved)
+    reserved_spans = [sp for spans in reserved.values() for sp in spans]
+    used = 0
+
+    def covering_spans(label):
+        return reserved_spans + [sp for other, picks in kept.items() if other != label for _, _, sps in picks for sp in sps]
+
+    def pick(label, term, source, spans):
+        nonlocal used
+        picked = chosen[label]
+        # Each term appears, and is charged to the budget, once across the whole prompt
+        if term in taken:
+            return False
+        if max_items and max_items > 0 and len(picked) >= max_items:
+            return False
+        # Within one vocab list, "pocketwatch" and "brass pocketwatch" say the same thing; keep the higher-ranked
+        if any(src == source and overlaps(term, other) for other, src, _ in kept[label]):
+            return False
+        # "brass" matched only inside "brass pocketwatch" adds nothing to another section
+        if inside_longer(spans, covering_spans(label)):
+            return False
+        cost = term_tokens(term)
+        if token_budget and used + cost > token_budget:
+            return False
+        picked.append(term)
+        kept[label].append((term, source, spans))
+        taken.add(term)
+        used += cost
+        return True
+
+    def hand_out(pending):
+        heapq.heapify(pending)
+        while pending:
+            entry = heapq.heappop(pending)
+            pick(entry[3], *entry[4:])
+
+    # Seed each non-empty section with its best usable term, strongest sections first. A seed must not
+    # sit inside a higher-ranked term from another section, which the heap pass would otherwise pick first.
+    unseeded = {label for label, candidates in sections.items() if candidates}
+    deferred = []
+    while heap and unseeded:
+        entry = heapq.heappop(heap)
+        label, spans = entry[3], entry[6]
+        ahead = [sp for e in deferred if e[3] != label for sp in e[6]]
+        if label in unseeded and not inside_longer(spans, ahead) and pick(label, *entry[4:]):
+            unseeded.discard(label)
+        else:
+            deferred.append(entry)
+
+    hand_out(heap + deferred)
+
+    # A pick can end up inside longer terms picked after it ("brass" once "brass goggles" and
+    # "brass pocketwatch" are both in). Drop it for good, refund its words and hand them out again.
+    while True:
+        redundant = [
+            (label, item) for label, picks in kept.items() for item in picks
+            if inside_longer(item[2], covering_spans(label))
+        ]
+        if not redundant:
+            break
+        for label, item in redundant:
+            kept[label].remove(item)
+            chosen[label].remove(item[0])
+            used -= term_tokens(item[0])
+        hand_out(list(entries))
+    return chosen
 
 def build_prompt(sections, mode="standard", use_labels=True):
     lines = []
@@ -258,6 +378,91 @@ STORY_PACKS = {
     }
 }
 
+BASE_VOCAB = {
+    "CHAR_ROLES": CHAR_ROLES, "CLOTHING": CLOTHING, "PHYS_ATTR": PHYS_ATTR, "OBJECTS": OBJECTS,
+    "ENVIRONMENTS": ENVIRONMENTS, "TIME_OF_DAY": TIME_OF_DAY, "WEATHER": WEATHER, "LIGHTING": LIGHTING,
+    "COLORS": COLORS, "CAMERA": CAMERA, "COMPOSITION": COMPOSITION, "MOOD": MOOD, "STYLE": STYLE,
+    "QUALITY": QUALITY, "EFFECTS": EFFECTS
+}
+
+# -----------------------------
+# Extraction (cached across reruns)
+# -----------------------------
+@st.cache_resource(max_entries=VOCAB_CACHE_SIZE)
+def merged_vocab(pack_name, custom_json=""):
+    # Story pack and custom pack terms merge into copies; the base sets are never mutated.
+    selected = STORY_PACKS.get(pack_name, {})
+    custom = json.loads(custom_json) if custom_json else {}
+    vocab = {}
+    for key in VOCAB_KEYS:
+        merged = set(BASE_VOCAB[key])
+        merged.update(term.lower() for term in selected.get(key, []))
+        merged.update(str(term).lower() for term in custom.get(key, []))
+        vocab[key] = frozenset(merged)
+    return vocab
+
+@st.cache_resource
+def corpus_idf():
+    # One document per base vocab set: words reused across categories ("light", "shadows", "hair") carry less
+    # signal. Story packs are left out, since every pack repeats the same style words ("anime", "cinematic").
+    # Words outside the base sets get the mean IDF rather than the maximum.
+    docs = [{w for t in terms for w in t.split()} for terms in BASE_VOCAB.values()]
+    df = Counter(w for doc in docs for w in doc)
+    n = len(docs)
+    idf = {w: math.log((1 + n) / (1 + c)) + 1.0 for w, c in df.items()}
+    return idf, sum(idf.values()) / len(idf)
+
+def idf_weight(term):
+    # A phrase is as distinctive as its most distinctive word
+    idf, neutral = corpus_idf()
+    words = term.lower().split()
+    if not words:
+        return 0.0
+    return max(idf.get(w, neutral) for w in words)
+
+@st.cache_resource(max_entries=VOCAB_CACHE_SIZE)
+def term_weights(pack_name, custom_json=""):
+    selected = {t.lower() for terms in STORY_PACKS.get(pack_name, {}).values() for t in terms}
+    custom = json.loads(custom_json) if custom_json else {}
+    custom_terms = {str(t).lower() for key in VOCAB_KEYS for t in custom.get(key, [])}
+    weights = {}
+    for terms in merged_vocab(pack_name, custom_json).values():
+        for term in terms:
+            weight = idf_weight(term)
+            if term in custom_terms:
+                weight *= CUSTOM_PRIORITY
+            elif term in selected:
+                weight *= PACK_PRIORITY
+            weights[term] = weight
+    return weights
+
+def extract_elements(text, pack_name, custom_json="", char_name=""):
+    # Memoized per session on the inputs that affect extraction; render-only options are not part of the key.
+    cache = st.session_state.setdefault("extraction_cache", OrderedDict())
+    key = (text, pack_name, custom_json, char_name)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    vocab = merged_vocab(pack_name, custom_json)
+    names = proper_names(text, vocab["ENVIRONMENTS"])
+    if char_name and char_name not in names:
+        names = [char_name] + names
+    weights = term_weights(pack_name, custom_json)
+    found = {"NAMES": names, "SCORES": {}, "SPANS": {}}
+    for k in VOCAB_KEYS:
+        spans = term_spans(text, vocab[k])
+        found[k] = list(spans)
+        for term, term_matches in spans.items():
+            score = salience(weights.get(term, 0.0), term_matches[0][0], len(text))
+            found["SCORES"][term] = max(score, found["SCORES"].get(term, 0.0))
+            found["SPANS"][term] = term_matches
+
+    cache[key] = found
+    while len(cache) > EXTRACTION_CACHE_SIZE:
+        cache.popitem(last=False)
+    return found
+
 st.subheader("1) Input")
 colA, colB = st.columns([2,1])
 with colA:
@@ -271,7 +476,6 @@ st.subheader("2) Options")
 pack = st.selectbox("Story pack", list(STORY_PACKS.keys()), index=0)
 with st.expander("Add a custom Story Pack (optional)"):
     st.write("Upload a JSON file or paste JSON defining extra vocabulary. It will merge on top of the selected pack.")
-    import json
     up = st.file_uploader("Upload JSON", type=["json"], accept_multiple_files=False)
     pasted = st.text_area("Or paste JSON here", height=140, placeholder='{"OBJECTS": ["new prop"], "ENVIRONMENTS": ["new place"]}')
     custom_pack = {}
@@ -297,75 +501,66 @@ with col3:
     use_labels = st.checkbox("Show section labels", value=True)
 
 max_items = st.slider("Max terms per section", min_value=0, max_value=20, value=10, help="0 = unlimited")
+token_budget = st.slider("Token budget", min_value=0, max_value=150, value=60, help="Approximate word budget for extracted terms across all sections. 0 = unlimited")
+
+custom_json = json.dumps(custom_pack, sort_keys=True) if isinstance(custom_pack, dict) and custom_pack else ""
+
+current_inputs = (detailed or "", pack, custom_json, char_name)
 
 if st.button("Perfect my prompt ✨", type="primary"):
-    text = detailed or ""
-
-    # Merge selected story pack vocab (extend the sets)
-    selected = STORY_PACKS.get(pack, {})
-    def extend_set(base_set, key):
-        for term in selected.get(key, []):
-            base_set.add(term.lower())
-
-    extend_set(CHAR_ROLES, "CHAR_ROLES")
-    extend_set(CLOTHING, "CLOTHING")
-    extend_set(PHYS_ATTR, "PHYS_ATTR")
-    extend_set(OBJECTS, "OBJECTS")
-    extend_set(ENVIRONMENTS, "ENVIRONMENTS")
-    extend_set(TIME_OF_DAY, "TIME_OF_DAY")
-    extend_set(WEATHER, "WEATHER")
-    extend_set(LIGHTING, "LIGHTING")
-    extend_set(COLORS, "COLORS")
-    extend_set(CAMERA, "CAMERA")
-    extend_set(COMPOSITION, "COMPOSITION")
-    extend_set(MOOD, "MOOD")
-    extend_set(STYLE, "STYLE")
-    extend_set(QUALITY, "QUALITY")
-    extend_set(EFFECTS, "EFFECTS")
-
-    # Merge custom pack too
-    if isinstance(custom_pack, dict) and custom_pack:
-        def extend_with_custom(base_set, key):
-            for term in custom_pack.get(key, []):
-                base_set.add(str(term).lower())
-        extend_with_custom(CHAR_ROLES, "CHAR_ROLES")
-        extend_with_custom(CLOTHING, "CLOTHING")
-        extend_with_custom(PHYS_ATTR, "PHYS_ATTR")
-        extend_with_custom(OBJECTS, "OBJECTS")
-        extend_with_custom(ENVIRONMENTS, "ENVIRONMENTS")
-        extend_with_custom(TIME_OF_DAY, "TIME_OF_DAY")
-        extend_with_custom(WEATHER, "WEATHER")
-        extend_with_custom(LIGHTING, "LIGHTING")
-        extend_with_custom(COLORS, "COLORS")
-        extend_with_custom(CAMERA, "CAMERA")
-        extend_with_custom(COMPOSITION, "COMPOSITION")
-        extend_with_custom(MOOD, "MOOD")
-        extend_with_custom(STYLE, "STYLE")
-        extend_with_custom(QUALITY, "QUALITY")
-        extend_with_custom(EFFECTS, "EFFECTS")
-
-    # Extracted elements
-    names = proper_names(text)
-    if char_name and char_name not in names:
-        names = [char_name] + names
+    st.session_state["extraction_inputs"] = current_inputs
+
+# Re-render from the last perfected inputs so label/brevity/max-terms/budget changes don't need another click
+extraction_inputs = st.session_state.get("extraction_inputs")
+if extraction_inputs is not None:
+    if extraction_inputs != current_inputs:
+        st.info("Scene text, story pack, custom pack or character name changed. Click \"Perfect my prompt ✨\" again to update the output.")
+    found = extract_elements(*extraction_inputs)
+
+    names = found["NAMES"]
+    roles = found["CHAR_ROLES"]
+    clothing = found["CLOTHING"]
+    phys = found["PHYS_ATTR"]
+    objs = found["OBJECTS"]
+    envs = found["ENVIRONMENTS"]
+    time = found["TIME_OF_DAY"]
+    weather = found["WEATHER"]
+    lighting = found["LIGHTING"]
+    colors = found["COLORS"]
+    camera = found["CAMERA"]
+    comp = found["COMPOSITION"]
+    mood = found["MOOD"]
+    style = found["STYLE"]
+    quality = found["QUALITY"]
+    fx = found["EFFECTS"]
+
+    # Rank the extracted terms; the chosen style preset is kept whole, outside the ranking and budget
+    scores = found["SCORES"]
+
+    def candidates(key, terms):
+        return [(term, scores[term], key, found["SPANS"][term]) for term in terms]
+
+    preset_bits = STYLE_PRESETS.get(style_choice, [])
+
+    ranked = select_terms(OrderedDict([
+        ("Main Character", candidates("CHAR_ROLES", roles) + candidates("PHYS_ATTR", phys) + candidates("CLOTHING", clothing)),
+        ("Secondary / Objects", candidates("OBJECTS", objs)),
+        ("Environment / Background", candidates("ENVIRONMENTS", envs)),
+        ("Lighting & Color", candidates("COLORS", colors) + candidates("LIGHTING", lighting)
+            + candidates("TIME_OF_DAY", time) + candidates("WEATHER", weather)),
+        ("Camera & Composition", candidates("CAMERA", camera) + candidates("COMPOSITION", comp)),
+        ("Mood / Emotion", candidates("MOOD", mood)),
+        ("Style & Quality", candidates("STYLE", style) + candidates("QUALITY", quality) + candidates("EFFECTS", fx)),
+    ]), max_items=max_items, token_budget=token_budget,
+        reserved={term: found["SPANS"].get(term, []) for term in preset_bits})
+    ranked["Style & Quality"] = list(preset_bits) + ranked["Style & Quality"]
+
+    # Compose sections; names and the user's character sheet sit outside the ranking
+    char_terms = ranked.pop("Main Character")
+    roles = [t for t in char_terms if t in roles]
+    phys = [t for t in char_terms if t in phys]
+    clothing = [t for t in char_terms if t in clothing]
 
-    roles = find_terms(text, CHAR_ROLES)
-    clothing = find_terms(text, CLOTHING)
-    phys = find_terms(text, PHYS_ATTR)
-    objs = find_terms(text, OBJECTS)
-    envs = find_terms(text, ENVIRONMENTS)
-    time = find_terms(text, TIME_OF_DAY)
-    weather = find_terms(text, WEATHER)
-    lighting = find_terms(text, LIGHTING)
-    colors = find_terms(text, COLORS)
-    camera = find_terms(text, CAMERA)
-    comp = find_terms(text, COMPOSITION)
-    mood = find_terms(text, MOOD)
-    style = find_terms(text, STYLE)
-    quality = find_terms(text, QUALITY)
-    fx = find_terms(text, EFFECTS)
-
-    # Compose sections
     char_bits = []
     if names:
         char_bits.append(", ".join(names[:2]))
@@ -378,42 +573,8 @@ if st.button("Perfect my prompt ✨", type="primary"):
     if clothing:
         char_bits.append(", ".join(clothing))
 
-    lighting_bits = []
-    if colors:
-        lighting_bits.append(", ".join(colors))
-    if lighting:
-        lighting_bits.append(", ".join(lighting))
-    if time:
-        lighting_bits.append(", ".join(time))
-    if weather:
-        lighting_bits.append(", ".join(weather))
-
-    camera_bits = []
-    if camera:
-        camera_bits.append(", ".join(camera))
-    if comp:
-        camera_bits.append(", ".join(comp))
-
-    style_bits = []
-    preset_bits = STYLE_PRESETS.get(style_choice, [])
-    if preset_bits:
-        style_bits.extend(preset_bits)
-    if style:
-        style_bits.extend(style)
-    if quality:
-        style_bits.extend(quality)
-    if fx:
-        style_bits.extend(fx)
-
-    sections = [
-        ("Main Character", ", ".join([s for s in char_bits if s]) if char_bits else ""),
-        ("Secondary / Objects", ", ".join(compress_list(objs, max_items))),
-        ("Environment / Background", ", ".join(compress_list(envs, max_items))),
-        ("Lighting & Color", ", ".join(compress_list(lighting_bits, max_items))),
-        ("Camera & Composition", ", ".join(compress_list(camera_bits, max_items))),
-        ("Mood / Emotion", ", ".join(compress_list(mood, max_items))),
-        ("Style & Quality", ", ".join(compress_list(style_bits, max_items))),
-    ]
+    sections = [("Main Character", ", ".join([s for s in char_bits if s]) if char_bits else "")]
+    sections += [(label, ", ".join(terms)) for label, terms in ranked.items()]
 
     if negative:
         sections.append(("Negative", negative.strip()))
@@ -1,6 +1,8 @@
 import streamlit as st
 import re
-from collections import defaultdict
+import heapq
+import math
+from collections import Counter, OrderedDict, defaultdict
 
 st.set_page_config(page_title="Kling Prompt Perfecter", layout="centered")
 
@@ -68,19 +70,39 @@ WARDROBE = [
     "apron", "goggles", "scarf", "gloves", "boots", "bracers", "belt", "satchel"
 ]
 
+# Style presets and quality anchors
+PRESET_STYLES = {
+    "The Clockwork Alchemist (Default)": [
+        "motion graphics anime", "cinematic", "dramatic lighting", "sharp focus"
+    ],
+    "Painterly Anime": ["anime", "illustrative", "soft shading"],
+    "Gritty Noir": ["noir", "high contrast", "film grain"],
+}
+
+QUALITY_TAGS = ["highly detailed", "4k", "depth of field"]  # safe, generic quality cues
+
+EXTRACTION_CACHE_SIZE = 16
+
+# Salience weighting: IDF x priority, decayed by how late a term first appears
+QUALITY_PRIORITY = 0.75
+HEURISTIC_PRIORITY = 0.75
+HAIR_EYES_PRIORITY = 1.5  # hair and eye cues keep a character consistent across generations
+POSITION_DECAY = 0.5
+
 # Regex helpers
 TOKEN_SPLIT = re.compile(r"[\s,.;:()\[\]{}\-_/]+")
 
 # Simple keyword finder (case-insensitive, matches whole words where possible)
 
-def find_keywords(text: str, vocab: list[str]) -> list[str]:
-    out = []
+def keyword_spans(text: str, vocab: list[str]) -> dict[str, list[tuple[int, int]]]:
+    out = {}
     low = text.lower()
     for v in vocab:
         # match whole phrase v as a substring boundary-aware when possible
         pattern = r"(?<!\w)" + re.escape(v.lower()) + r"(?!\w)"
-        if re.search(pattern, low):
-            out.append(v)
+        spans = [m.span() for m in re.finditer(pattern, low)]
+        if spans:
+            out[v] = spans
     return out
 
 # Extract noun-ish candidates (very heuristic, no NLP deps)
@@ -91,86 +113,231 @@ def noun_candidates(text: str) -> list[str]:
     cands = [w.lower() for w in words if len(w) > 3 and w.isalpha()]
     return list(dict.fromkeys(cands))  # dedupe, keep order
 
-# Compress list to top-N unique tokens, preserving original order
+# Precomputed term weights: IDF with every vocab phrase as a document, so words reused across many
+# phrases ("light", "hair", "shot") count for less than one-off nouns
+
+@st.cache_resource
+def corpus_idf() -> tuple[dict[str, float], float]:
+    vocabs = [CHARACTERS, OBJECTS, ENVIRONMENTS, LIGHTING, CAMERA, MOOD, STYLE, HAIR_EYES, WARDROBE, QUALITY_TAGS]
+    docs = [set(t.lower().split()) for terms in vocabs + list(PRESET_STYLES.values()) for t in terms]
+    df = Counter(w for doc in docs for w in doc)
+    n = len(docs)
+    idf = {w: math.log((1 + n) / (1 + c)) + 1.0 for w, c in df.items()}
+    # Words outside the vocab get the mean rather than the maximum
+    return idf, sum(idf.values()) / len(idf)
+
+def term_weight(term: str) -> float:
+    # a phrase is as distinctive as its most distinctive word
+    idf, neutral = corpus_idf()
+    words = term.lower().split()
+    if not words:
+        return 0.0
+    return max(idf.get(w, neutral) for w in words)
+
+def salience(weight: float, position: int | None = None, text_len: int = 0) -> float:
+    # Terms not found in the text (quality anchors) rank as if mentioned last
+    if position is None:
+        return weight * (1.0 - POSITION_DECAY)
+    if not text_len:
+        return weight
+    return weight * (1.0 - POSITION_DECAY * position / text_len)
+
+def overlaps(a: str, b: str) -> bool:
+    a, b = f" {a.lower()} ", f" {b.lower()} "
+    return a in b or b in a
+
+def inside_longer(spans: list[tuple[int, int]], taken: list[tuple[int, int]]) -> bool:
+    # every match lies inside a longer match that was already picked
+    return bool(spans) and all(
+        any(s <= a and b <= e and b - a < e - s for s, e in taken) for a, b in spans
+    )
 
-def compress(items: list[str], n: int) -> list[str]:
-    seen = set()
-    out = []
-    for it in items:
-        if it.lower() not in seen:
-            out.append(it)
-            seen.add(it.lower())
-        if len(out) >= n:
+# Pick the most salient terms per section under a shared word budget: every non-empty section first
+# gets its best term, then one heap over all sections hands out the rest
+
+def select_terms(
+    buckets: dict[str, list[tuple[str, float, str, list[tuple[int, int]]]]],
+    per_section_cap: int,
+    token_budget: int = 0,
+    reserved: dict[str, list[tuple[int, int]]] | None = None,
+) -> dict[str, list[str]]:
+    # reserved terms are already in the prompt outside the ranking; they are never repeated and
+    # their match spans cover shorter terms like any other pick
+    heap = []
+    for s_idx, (k, candidates) in enumerate(buckets.items()):
+        for i, (it, score, source, spans) in enumerate(candidates):
+            heap.append((-score, s_idx, i, k, it, source, spans))
+    entries = list(heap)
+    heapq.heapify(heap)
+
+    chosen = {k: [] for k in buckets}
+    kept = {k: [] for k in buckets}
+    reserved = reserved or {}
+    taken = {r.lower() for r in reserved}
+    reserved_spans = [sp for spans in reserved.values() for sp in spans]
+    used = 0
+
+    def covering_spans(k: str) -> list[tuple[int, int]]:
+        return reserved_spans + [sp for other, picks in kept.items() if other != k for _, _, sps in picks for sp in sps]
+
+    def pick(k: str, it: str, source: str, spans: list[tuple[int, int]]) -> bool:
+        nonlocal used
+        picked = chosen[k]
+        # each term appears, and is charged to the budget, once across the whole prompt
+        if it.lower() in taken:
+            return False
+        if len(picked) >= per_section_cap:
+            return False
+        # within one vocab list, "hooded cloak" and "cloak" say the same thing; keep the higher-ranked
+        if any(src == source and overlaps(it, p) for p, src, _ in kept[k]):
+            return False
+        # a match that only occurs inside a longer pick from another section adds nothing
+        if inside_longer(spans, covering_spans(k)):
+            return False
+        cost = len(it.split())  # rough token cost
+        if token_budget and used + cost > token_budget:
+            return False
+        picked.append(it)
+        kept[k].append((it, source, spans))
+        taken.add(it.lower())
+        used += cost
+        return True
+
+    def hand_out(pending: list) -> None:
+        heapq.heapify(pending)
+        while pending:
+            entry = heapq.heappop(pending)
+            pick(entry[3], *entry[4:])
+
+    # seed each non-empty section with its best usable term, strongest sections first; a seed must not
+    # sit inside a higher-ranked term from another section, which the heap pass would otherwise pick first
+    unseeded = {k for k, candidates in buckets.items() if candidates}
+    deferred = []
+    while heap and unseeded:
+        entry = heapq.heappop(heap)
+        k, spans = entry[3], entry[6]
+        ahead = [sp for e in deferred if e[3] != k for sp in e[6]]
+        if k in unseeded and not inside_longer(spans, ahead) and pick(k, *entry[4:]):
+            unseeded.discard(k)
+        else:
+            deferred.append(entry)
+
+    hand_out(heap + deferred)
+
+    # a pick can end up inside longer terms picked after it ("brass" once "brass goggles" and
+    # "brass pocketwatch" are both in); drop it for good, refund its words and hand them out again
+    while True:
+        redundant = [(k, item) for k, picks in kept.items() for item in picks if inside_longer(item[2], covering_spans(k))]
+        if not redundant:
             break
-    return out
-
-# Build Kling-structured prompt
-
-def build_prompt(
-    master: str,
-    character_sheet: str | None = None,
-    strict: bool = True,
-    per_section_cap: int = 7,
-    style_preset: str | None = None,
-    add_quality: bool = True,
-):
-    master_norm = normalize(master)
+        for k, item in redundant:
+            kept[k].remove(item)
+            chosen[k].remove(item[0])
+            used -= len(item[0].split())
+        hand_out(list(entries))
+    return chosen
+
+# Extract section buckets from the master text (memoized per session)
+
+def extract_buckets(master_norm: str) -> dict[str, list[tuple[str, float, str, list[tuple[int, int]]]]]:
+    # Each bucket holds (term, salience, source vocab, match spans) candidates in order of discovery
+    cache = st.session_state.setdefault("extraction_cache", OrderedDict())
+    if master_norm in cache:
+        cache.move_to_end(master_norm)
+        return cache[master_norm]
 
     buckets = defaultdict(list)
 
     # Core finds from controlled vocabs
-    buckets["Character"].extend(find_keywords(master_norm, CHARACTERS))
-    buckets["Character"].extend(find_keywords(master_norm, HAIR_EYES))
-    buckets["Character"].extend(find_keywords(master_norm, WARDROBE))
-
-    buckets["Objects / Secondary"].extend(find_keywords(master_norm, OBJECTS))
-    buckets["Environment"].extend(find_keywords(master_norm, ENVIRONMENTS))
-    buckets["Lighting / Color"].extend(find_keywords(master_norm, LIGHTING))
-    buckets["Camera / Composition"].extend(find_keywords(master_norm, CAMERA))
-    buckets["Mood / Emotion"].extend(find_keywords(master_norm, MOOD))
-    buckets["Style & Quality"].extend(find_keywords(master_norm, STYLE))
+    sources = [
+        ("Character", "CHARACTERS", CHARACTERS),
+        ("Character", "HAIR_EYES", HAIR_EYES),
+        ("Character", "WARDROBE", WARDROBE),
+        ("Objects / Secondary", "OBJECTS", OBJECTS),
+        ("Environment", "ENVIRONMENTS", ENVIRONMENTS),
+        ("Lighting / Color", "LIGHTING", LIGHTING),
+        ("Camera / Composition", "CAMERA", CAMERA),
+        ("Mood / Emotion", "MOOD", MOOD),
+        ("Style & Quality", "STYLE", STYLE),
+    ]
+    text_len = len(master_norm)
+    for k, source, vocab in sources:
+        priority = HAIR_EYES_PRIORITY if source == "HAIR_EYES" else 1.0
+        for term, spans in keyword_spans(master_norm, vocab).items():
+            weight = term_weight(term) * priority
+            buckets[k].append((term, salience(weight, spans[0][0], text_len), source, spans))
 
     # Heuristic extras: noun candidates that look environment-ish or object-ish
     nouns = noun_candidates(master_norm)
     # Add any nouns that are not already present and look relevant
+    found = {t for k in ("Environment", "Objects / Secondary") for t, _, _, _ in buckets[k]}
     for n in nouns:
-        if n in buckets["Environment"] or n in buckets["Objects / Secondary"]:
+        if n in found:
             continue
         # crude guesses
         if n.endswith("shop") or n.endswith("room") or n in {"ruins", "market", "harbor", "cathedral"}:
-            buckets["Environment"].append(n)
+            guess, k = n, "Environment"
         elif n in {"lanterns", "gears", "cogs", "machine", "device", "contraption", "blueprints"}:
-            buckets["Objects / Secondary"].append(n.rstrip('s'))
+            guess, k = n.rstrip('s'), "Objects / Secondary"
+        else:
+            continue
+        weight = term_weight(guess) * HEURISTIC_PRIORITY
+        spans = keyword_spans(master_norm, [n]).get(n, [])
+        position = spans[0][0] if spans else None
+        buckets[k].append((guess, salience(weight, position, text_len), "NOUNS", spans))
 
-    # Optional preset and quality anchors
-    preset_styles = {
-        "The Clockwork Alchemist (Default)": [
-            "motion graphics anime", "cinematic", "dramatic lighting", "sharp focus"
-        ],
-        "Painterly Anime": ["anime", "illustrative", "soft shading"],
-        "Gritty Noir": ["noir", "high contrast", "film grain"],
-    }
+    cache[master_norm] = dict(buckets)
+    while len(cache) > EXTRACTION_CACHE_SIZE:
+        cache.popitem(last=False)
+    return cache[master_norm]
 
-    if style_preset and style_preset in preset_styles:
-        buckets["Style & Quality"].extend(preset_styles[style_preset])
+# Build Kling-structured prompt
 
+def build_prompt(
+    master: str,
+    character_sheet: str | None = None,
+    strict: bool = True,
+    per_section_cap: int = 7,
+    style_preset: str | None = None,
+    add_quality: bool = True,
+    token_budget: int = 0,
+):
+    master_norm = normalize(master)
+
+    # Copy the cached buckets; the preset and quality anchors are layered on per call
+    buckets = defaultdict(list)
+    for k, candidates in extract_buckets(master_norm).items():
+        buckets[k].extend(candidates)
+
+    # The chosen preset is kept whole, outside the ranking and budget
+    preset_terms = PRESET_STYLES.get(style_preset, []) if style_preset else []
+
+    # Optional quality anchors, scored as if mentioned last so scene terms keep priority
     if add_quality:
-        buckets["Style & Quality"].extend(["highly detailed", "4k", "depth of field"])  # safe, generic quality cues
+        buckets["Style & Quality"].extend(
+            (t, salience(term_weight(t) * QUALITY_PRIORITY), "QUALITY", []) for t in QUALITY_TAGS
+        )
 
-    # Deduplicate + compress
+    # Deduplicate, then keep the most salient terms
     for k in list(buckets.keys()):
         items = buckets[k]
         # remove near-duplicates by lowercase set while preserving order
         deduped = []
         seen = set()
         for it in items:
-            key = it.lower()
+            key = it[0].lower()
             if key not in seen:
                 deduped.append(it)
                 seen.add(key)
-        if strict:
-            deduped = compress(deduped, per_section_cap)
         buckets[k] = deduped
+    if strict:
+        reserved = {t: keyword_spans(master_norm, [t]).get(t, []) for t in preset_terms}
+        buckets = select_terms(buckets, per_section_cap, token_budget, reserved=reserved)
+    else:
+        buckets = {k: [it for it, _, _, _ in candidates] for k, candidates in buckets.items()}
+    preset_keys = {t.lower() for t in preset_terms}
+    style_terms = [it for it in buckets.get("Style & Quality", []) if it.lower() not in preset_keys]
+    buckets["Style & Quality"] = list(preset_terms) + style_terms
 
     # Build lines in desired order
     lines = []
@@ -220,10 +387,14 @@ with st.form("pp_form"):
     with col1:
         strict = st.checkbox("Stricter compression (shorter output)", value=True)
         per_cap = st.slider("Max items per section", min_value=3, max_value=12, value=7)
+        token_budget = st.slider(
+            "Token budget (strict only)", min_value=0, max_value=120, value=60,
+            help="Approximate word budget across all sections. 0 = unlimited",
+        )
     with col2:
         style_preset = st.selectbox(
             "Style Preset",
-            ["The Clockwork Alchemist (Default)", "Painterly Anime", "Gritty Noir", "None"],
+            list(PRESET_STYLES) + ["None"],
             index=0,
         )
         add_quality = st.checkbox("Add quality tags (highly detailed, 4k, DoF)", value=True)
@@ -242,6 +413,7 @@ if submitted:
             per_section_cap=per_cap,
             style_preset=preset_name,
             add_quality=add_quality,
+            token_budget=token_budget,
         )
 
         st.subheader("Kling-Optimized Prompt")